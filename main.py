@@ -1,15 +1,32 @@
 import os
+import re
+import html
+import json
 import argparse
+import shutil
 import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import urlparse, urlunparse
 
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3.exceptions
 import bs4
+import lxml.etree
+import lxml.html
 from markdownify import MarkdownConverter
 from atlassian import Confluence
 
 ATTACHMENT_FOLDER_NAME = "attachments"
+MANIFEST_FILE_NAME = ".manifest.json"
+ATTACHMENT_ETAGS_FILE_NAME = ".attach_etags.json"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".flv", ".wmv", ".m4v", ".webm")
 DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
+SPACE_SCAN_LIMIT = 200
+PAGE_WORKERS = 16
+DOWNLOAD_WORKERS = 8
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,17 +42,75 @@ class Exporter:
         self.__parsed_url = urlparse(url)
         self.__username = username
         self.__token = token
+        # Every page worker calls the API through this client, so its pool must hold a connection per worker
         self.__confluence = Confluence(url=urlunparse(self.__parsed_url),
                                        username=self.__username,
-                                       password=self.__token)
+                                       password=self.__token,
+                                       session=self.__create_session(PAGE_WORKERS))
+        # A shared session keeps connections alive across attachment downloads
+        self.__session = self.__create_session(32)
+        self.__session.auth = (self.__username, self.__token)
         self.__seen = set()
         self.__no_attach = no_attach
         self.__space = space
         self.__removable_parents = removable_parents
+        self.__download_executor = None
+        self.__created_dirs = set()
 
         # Ensure the output directory exists
         os.makedirs(self.__out_dir, exist_ok=True)
 
+        # Page versions written by previous exports, used to skip unchanged pages
+        self.__manifest_filename = os.path.join(self.__out_dir, MANIFEST_FILE_NAME)
+        self.__manifest = self.__load_manifest(self.__manifest_filename)
+
+        # ETags of downloaded attachments, used to revalidate them with conditional requests
+        self.__attachment_etags_filename = os.path.join(self.__out_dir, ATTACHMENT_ETAGS_FILE_NAME)
+        self.__attachment_etags = self.__load_manifest(self.__attachment_etags_filename)
+
+    @staticmethod
+    def __create_session(pool_maxsize):
+        """
+        Create a session that keeps up to pool_maxsize connections alive per host.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @staticmethod
+    def __load_manifest(manifest_filename):
+        """
+        Load a JSON manifest written by a previous export, if any.
+        """
+        try:
+            with open(manifest_filename, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable manifest %s: %s", manifest_filename, e)
+            return {}
+
+    @staticmethod
+    def __save_manifest(manifest_filename, manifest):
+        """
+        Atomically replace a JSON manifest with the given content.
+        """
+        tmp_filename = manifest_filename + ".tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_filename, manifest_filename)
+
+    def __ensure_dir(self, path):
+        """
+        Create a directory and its parents, skipping the filesystem calls for directories already created.
+        """
+        if path not in self.__created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.__created_dirs.add(path)
+
     @staticmethod
     def __sanitize_filename(document_name_raw):
         """
@@ -49,27 +124,19 @@ class Exporter:
                 document_name = document_name.replace(invalid, "_")
         return document_name
 
-    def __dump_page(self, src_id, parents):
+    def __dump_page(self, page, parents, children):
         """
         Dump a single Confluence page to the output directory, including its attachments.
-        Recursively process any child pages.
+        The page is skipped if its version has not changed since the last export
+        and its attachments were fetched then, or are not wanted now.
+        Return the (child_page, parents) pairs of its child pages.
         """
-        if src_id in self.__seen:
-            raise ExportException("Duplicate Page ID Found!")
-
-        page = self.__confluence.get_page_by_id(src_id, expand="body.storage,version")
         page_title = page["title"]
         page_id = page["id"]
-
-        child_ids = self.__confluence.get_child_id_list(page_id)
-        content = page["body"]["storage"]["value"]
-        last_updated = page["version"]["when"]
-
-        # Add last updated timestamp to the content
-        content += f'<div>Last updated: {last_updated}</div>'
+        version = page["version"]["number"]
 
         extension = ".html"
-        document_name = "index" if child_ids else page_title
+        document_name = "index" if children else page_title
 
         sanitized_filename = self.__sanitize_filename(document_name) + extension
         sanitized_parents = list(map(self.__sanitize_filename, parents))
@@ -79,32 +146,110 @@ class Exporter:
 
         page_location = sanitized_parents + [sanitized_filename]
         page_filename = os.path.join(self.__out_dir, *page_location)
+        child_parents = sanitized_parents + [page_title]
+
+        # With --remove-html, only the Markdown file converted from the page is left
+        exported = os.path.exists(page_filename) or os.path.exists(os.path.splitext(page_filename)[0] + ".md")
+        entry = self.__manifest.get(page_id)
+        if (entry is not None and entry["version"] == version and (entry["attachments"] or self.__no_attach)
+                and exported):
+            logging.info("Unchanged since last export, skipping %s", " / ".join(page_location))
+            return [(child, child_parents) for child in children]
+
+        # Unless the space scan included bodies, fetch the body of a changed page here,
+        # so it overlaps with the other workers
+        if "body" not in page:
+            page = self.__confluence.get_page_by_id(page_id, expand="body.storage,version")
+        content = page["body"]["storage"]["value"]
+        last_updated = page["version"]["when"]
 
         # Ensure the directory for the page exists
-        os.makedirs(os.path.dirname(page_filename), exist_ok=True)
+        self.__ensure_dir(os.path.dirname(page_filename))
         logging.info("Saving to %s", " / ".join(page_location))
 
-        # Save the page content to an HTML file
+        # Save the page content to an HTML file, followed by its last updated timestamp
+        # Written separately to avoid copying the whole page into a concatenated string
         with open(page_filename, "w", encoding="utf-8") as f:
             f.write(content)
+            f.write(f'<div>Last updated: {last_updated}</div>')
 
         # Fetch and save attachments if not disabled
-        if not self.__no_attach:
-            self.__fetch_attachments(page_id, page_filename)
+        if self.__no_attach:
+            attachments = False
+        elif self.__fetch_attachments(page_id, page_filename):
+            attachments = True
+        else:
+            # Leave the page out of the manifest, so the failed downloads are retried by the next export
+            self.__manifest.pop(page_id, None)
+            return [(child, child_parents) for child in children]
+
+        self.__manifest[page_id] = {"version": page["version"]["number"], "attachments": attachments}
 
-        self.__seen.add(page_id)
+        return [(child, child_parents) for child in children]
 
-        # Recursively process child pages
-        for child_id in child_ids:
-            self.__dump_page(child_id, parents=sanitized_parents + [page_title])
+    def __fetch_space_pages(self, space_key):
+        """
+        Fetch every page of a space, with version and ancestors, in a paginated bulk scan.
+        Without a previous export every page is written, so bodies are included in the scan;
+        otherwise they are left out, so unchanged pages never transfer them.
+        Return a dict of pages by ID.
+        """
+        expand = "version,ancestors" if self.__manifest else "body.storage,version,ancestors"
+        pages = {}
+        start = 0
+        while True:
+            results = self.__confluence.get_all_pages_from_space(space_key, start=start, limit=SPACE_SCAN_LIMIT,
+                                                                 expand=expand)
+            if not results:
+                break
+            for page in results:
+                pages[page["id"]] = page
+            # The server may cap the page size below the requested limit
+            start += len(results)
+        logging.info("Fetched %d pages from space %s", len(pages), space_key)
+        return pages
+
+    def __dump_tree(self, root_id, pages):
+        """
+        Dump a page and all of its descendants from the pages of a space scan.
+        Pages are taken from a work queue by a pool of workers, and the children of a page
+        are queued as soon as it is done. Only this thread touches the queue and the seen set.
+        """
+        if root_id not in pages:
+            raise ExportException("Homepage not found in space")
+
+        # The direct parent of a page is the last of its ancestors
+        children = collections.defaultdict(list)
+        for page in pages.values():
+            if page["ancestors"]:
+                children[page["ancestors"][-1]["id"]].append(page)
+
+        root = pages[root_id]
+        queue = collections.deque([(root, [])])
+        pending = set()
+        with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+            while queue or pending:
+                while queue:
+                    page, parents = queue.popleft()
+                    if page["id"] in self.__seen:
+                        raise ExportException("Duplicate Page ID Found!")
+                    self.__seen.add(page["id"])
+                    pending.add(executor.submit(self.__dump_page, page, parents, children[page["id"]]))
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    queue.extend(future.result())
 
     def __fetch_attachments(self, page_id, page_filename):
         """
         Fetch and save attachments for a given page.
         Only image attachments are saved locally; others are linked to their Atlassian URLs.
+        Return whether every image download succeeded.
         """
         ret = self.__confluence.get_attachments_from_content(page_id, start=0, limit=500)
         page_dir = os.path.dirname(page_filename)
+        downloads = []
+        links = []
         for attachment in ret["results"]:
             att_title = attachment["title"]
             download = attachment["_links"]["download"]
@@ -114,50 +259,77 @@ class Exporter:
 
             att_sanitized_name = self.__sanitize_filename(att_title)
             att_filename = os.path.join(page_dir, ATTACHMENT_FOLDER_NAME, att_sanitized_name)
-            os.makedirs(os.path.dirname(att_filename), exist_ok=True)
+            self.__ensure_dir(os.path.dirname(att_filename))
 
             mime_type = attachment["metadata"]["mediaType"]
             if mime_type.startswith("image/"):
                 logging.info("Checking for existing image attachment %s", att_filename)
-                if os.path.exists(att_filename):
+                if os.path.exists(att_filename) and self.__attachment_etag_key(att_filename) not in self.__attachment_etags:
                     logging.info("Attachment %s already exists. Skipping download.", att_filename)
                 else:
                     logging.info("Saving image attachment %s to %s", att_title, att_filename)
-                    self.__download_attachment(att_url, att_filename)
+                    downloads.append((att_url, att_filename))
             else:
                 logging.info("Adding link to non-image attachment %s", att_title)
-                self.__add_attachment_link(page_filename, att_title, att_url)
+                links.append((att_title, att_url))
+
+        if links:
+            self.__add_attachment_links(page_filename, links)
+
+        # Download the images concurrently; consuming the results surfaces any worker exception
+        if not downloads:
+            return True
+        att_urls, att_filenames = zip(*downloads)
+        return all(list(self.__download_executor.map(self.__download_attachment, att_urls, att_filenames)))
+
+    def __attachment_etag_key(self, att_filename):
+        """
+        Key attachment ETags by local path, as the download URL changes with each attachment version.
+        """
+        return os.path.relpath(att_filename, self.__out_dir)
 
     def __download_attachment(self, att_url, att_filename):
         """
         Download an attachment from Confluence and save it locally.
+        A previously downloaded attachment is only transferred again if its ETag changed.
+        Return whether the attachment is saved and up to date.
         """
+        etag_key = self.__attachment_etag_key(att_filename)
+        # Download to a temporary file first, so a failed download never leaves a truncated attachment behind
+        part_filename = att_filename + ".part"
+        headers = {}
+        if etag_key in self.__attachment_etags and os.path.exists(att_filename):
+            headers["If-None-Match"] = self.__attachment_etags[etag_key]
+
         try:
-            with requests.get(att_url, auth=(self.__username, self.__token), stream=True) as r:
+            with self.__session.get(att_url, headers=headers, stream=True) as r:
+                if r.status_code == 304:
+                    logging.info("Attachment %s is unchanged. Skipping download.", att_filename)
+                    return True
                 r.raise_for_status()
-                with open(att_filename, "wb") as f:
-                    for buf in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
-                        f.write(buf)
-        except requests.RequestException as e:
+                # Let urllib3 undo any Content-Encoding, as iter_content would
+                r.raw.decode_content = True
+                with open(part_filename, "wb") as f:
+                    shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                os.replace(part_filename, att_filename)
+                if "ETag" in r.headers:
+                    self.__attachment_etags[etag_key] = r.headers["ETag"]
+            return True
+        # Reading r.raw directly bypasses requests, so a connection broken mid-body raises urllib3's errors
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
             logging.error("Error downloading attachment %s: %s", att_url, e)
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+            return False
 
-    def __add_attachment_link(self, page_filename, att_title, att_url):
+    def __add_attachment_links(self, page_filename, links):
         """
-        Add a link to a non-image attachment in the HTML content of a page.
+        Add links to the non-image attachments of a page in its HTML content.
+        The page is a body fragment written by __dump_page, so the links are simply appended to it.
         """
-        with open(page_filename, "r+", encoding="utf-8") as f:
-            content = f.read()
-            soup = bs4.BeautifulSoup(content, 'html.parser')
-            body = soup.body
-            if body is None:
-                body = soup.new_tag("body")
-                soup.append(body)
-            link_tag = soup.new_tag("a", href=att_url)
-            link_tag.string = att_title
-            body.append(link_tag)
-            f.seek(0)
-            f.write(str(soup))
-            f.truncate()
+        with open(page_filename, "a", encoding="utf-8") as f:
+            for att_title, att_url in links:
+                f.write(f'<a href="{html.escape(att_url)}">{html.escape(att_title)}</a>')
 
     def __dump_space(self, space):
         """
@@ -171,7 +343,8 @@ class Exporter:
             raise ExportException("No homepage found")
         else:
             homepage_id = homepage["id"]
-            self.__dump_page(homepage_id, parents=[])
+            pages = self.__fetch_space_pages(space_key)
+            self.__dump_tree(homepage_id, pages)
 
     def dump(self):
         """
@@ -182,9 +355,16 @@ class Exporter:
             logging.error("No spaces found in confluence. Please check credentials")
             return
 
-        for space in ret["results"]:
-            if self.__space is None or space["key"] == self.__space:
-                self.__dump_space(space)
+        try:
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_executor:
+                self.__download_executor = download_executor
+                for space in ret["results"]:
+                    if self.__space is None or space["key"] == self.__space:
+                        self.__dump_space(space)
+        finally:
+            # Record what was written so far, so an interrupted export resumes where it stopped
+            self.__save_manifest(self.__manifest_filename, self.__manifest)
+            self.__save_manifest(self.__attachment_etags_filename, self.__attachment_etags)
 
 
 class CustomMarkdownConverter(MarkdownConverter):
@@ -204,116 +384,444 @@ class CustomMarkdownConverter(MarkdownConverter):
         return super().convert_tag(el, text, convert_as_inline)
 
 
+class LxmlMarkdownConverter:
+    """
+    Convert an lxml HTML tree to Markdown in a single recursive walk.
+    Follows markdownify's default rules for the tags found in Confluence pages;
+    any other tag is rendered through its content.
+    """
+    BULLETS = "*+-"
+    SKIPPED_TAGS = {"head", "script", "style", "title"}
+
+    def convert(self, root):
+        """
+        Convert the given element and its content to Markdown.
+        """
+        md = self.__process(root, inline=False, depth=0)
+        return re.sub(r"\n{3,}", "\n\n", md).strip() + "\n"
+
+    @staticmethod
+    def __text(text, inline):
+        """
+        Render a text node: collapse whitespace and escape Markdown and HTML syntax, as markdownify does.
+        """
+        if not text:
+            return ""
+        text = re.sub(r"\s+", " ", text)
+        text = re.sub(r"([\\*_`<>&])", r"\\\1", text)
+        # A text node may start a line, where these would begin a heading, a list or a rule
+        text = re.sub(r"^(\s*)([#+=-]+)", lambda m: m.group(1) + re.sub(r"(.)", r"\\\1", m.group(2)), text)
+        text = re.sub(r"^(\s*\d+)([.)])", r"\1\\\2", text)
+        if inline:
+            text = text.replace("|", "\\|")
+        return text
+
+    def __children(self, el, inline, depth):
+        """
+        Render the text and child elements of an element, including each child's tail.
+        """
+        parts = [self.__text(el.text, inline)]
+        for child in el:
+            # Comments and processing instructions have a non-string tag but may carry a tail
+            if isinstance(child.tag, str):
+                parts.append(self.__process(child, inline, depth))
+            parts.append(self.__text(child.tail, inline))
+        # Whitespace next to a block would otherwise be left on a line of its own
+        return "".join(part for i, part in enumerate(parts)
+                       if not (part.isspace() and (i > 0 and parts[i - 1].endswith("\n")
+                                                   or i + 1 < len(parts) and parts[i + 1].startswith("\n"))))
+
+    @staticmethod
+    def __longest_backtick_run(text):
+        """
+        Return the length of the longest run of backticks in the given text.
+        """
+        return max((len(run) for run in re.findall(r"`+", text)), default=0)
+
+    def __fence(self, code, language):
+        """
+        Render code verbatim in a fenced block; the fence must be longer than any run of backticks in the code.
+        """
+        code = code.strip("\n")
+        fence = "`" * max(3, self.__longest_backtick_run(code) + 1)
+        return f"\n\n{fence}{language}\n{code}\n{fence}\n\n"
+
+    @staticmethod
+    def __wrap(text, marker):
+        """
+        Wrap inline text in a marker, keeping its surrounding whitespace outside of the marker.
+        """
+        stripped = text.strip()
+        if not stripped:
+            return text
+        prefix = " " if text[0].isspace() else ""
+        suffix = " " if text[-1].isspace() else ""
+        return f"{prefix}{marker}{stripped}{marker}{suffix}"
+
+    @staticmethod
+    def __block(text, inline):
+        """
+        Separate a block from its neighbours, or just with spaces inside inline-only contexts.
+        """
+        if inline:
+            return f" {text.strip()} "
+        return f"\n\n{text.strip()}\n\n"
+
+    def __process(self, el, inline, depth):
+        """
+        Render an element according to its tag.
+        """
+        tag = el.tag
+        if tag in self.SKIPPED_TAGS:
+            return ""
+
+        if tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            text = self.__children(el, True, depth).strip()
+            if inline or not text:
+                return text
+            if tag == "h1":
+                return f"\n\n{text}\n{'=' * len(text)}\n\n"
+            if tag == "h2":
+                return f"\n\n{text}\n{'-' * len(text)}\n\n"
+            return f"\n\n{'#' * int(tag[1])} {text}\n\n"
+
+        if tag in ("p", "div"):
+            return self.__block(self.__children(el, inline, depth), inline)
+
+        if tag == "br":
+            return " " if inline else "  \n"
+
+        if tag == "hr":
+            return self.__block("---", inline)
+
+        if tag in ("strong", "b"):
+            return self.__wrap(self.__children(el, inline, depth), "**")
+
+        if tag in ("em", "i"):
+            return self.__wrap(self.__children(el, inline, depth), "*")
+
+        if tag == "code":
+            code = el.text_content()
+            if not code:
+                return ""
+            # The delimiter must be longer than any run of backticks in the code
+            fence = "`" * (self.__longest_backtick_run(code) + 1)
+            if code.startswith("`") or code.endswith("`"):
+                code = f" {code} "
+            return f"{fence}{code}{fence}"
+
+        if tag == "pre":
+            return self.__fence(el.text_content(), "")
+
+        if tag == "ac:structured-macro" and el.get("ac:name") == "code":
+            # Code macros hold their language in a parameter and their code, verbatim, in a plain text body
+            language = next((param.text_content().strip() for param in el.iter("ac:parameter")
+                             if param.get("ac:name") == "language"), "")
+            body = next(el.iter("ac:plain-text-body"), None)
+            return self.__fence("" if body is None else body.text_content(), language)
+
+        if tag == "ac:plain-text-body":
+            # The body of other plain text macros, such as noformat, is kept verbatim too
+            return self.__fence(el.text_content(), "")
+
+        if tag == "a":
+            text = self.__children(el, inline, depth)
+            href = el.get("href")
+            if not href:
+                return text
+            if text == href:
+                return f"<{href}>"
+            return f"[{text}]({href})"
+
+        if tag == "img":
+            return f"![{el.get('alt', '')}]({el.get('src', '')})"
+
+        if tag == "video":
+            # Kept as HTML, as Markdown has no syntax for embedded video
+            sources = "".join(f'<source src="{source.get("src")}" type="{source.get("type")}">'
+                              for source in el.iter("source"))
+            return f"<video controls>{sources}</video>"
+
+        if tag in ("ul", "ol"):
+            return self.__list(el, inline, depth)
+
+        if tag == "blockquote":
+            # Collapse the separators between quoted blocks before every line is quoted
+            text = re.sub(r"\n{3,}", "\n\n", self.__children(el, inline, depth)).strip()
+            if inline:
+                return f" {text} "
+            quoted = "\n".join(f"> {line}" if line else ">" for line in text.split("\n"))
+            return f"\n\n{quoted}\n\n"
+
+        if tag == "table":
+            return self.__table(el, inline, depth)
+
+        return self.__children(el, inline, depth)
+
+    def __list(self, el, inline, depth):
+        """
+        Render an ordered or unordered list; nested lists are indented by four spaces.
+        """
+        try:
+            start = int(el.get("start", 1))
+        except ValueError:
+            start = 1
+        items = []
+        for child in el:
+            if child.tag != "li":
+                continue
+            if el.tag == "ol":
+                bullet = f"{start + len(items)}."
+            else:
+                bullet = self.BULLETS[depth % len(self.BULLETS)]
+            text = re.sub(r"\n{2,}", "\n", self.__children(child, inline, depth + 1).strip())
+            lines = text.split("\n")
+            items.append("\n".join([f"{bullet} {lines[0]}"] + [f"    {line}" for line in lines[1:]]))
+        if inline:
+            return " ".join(items)
+        return "\n\n" + "\n".join(items) + "\n\n"
+
+    def __table(self, el, inline, depth):
+        """
+        Render a table; the first row is used as the header row.
+        A table nested in an inline context, such as another table's cell, is flattened to its text.
+        """
+        rows = []
+        for row in el.iter("tr"):
+            # Rows of nested tables are rendered by their own table
+            if next(row.iterancestors("table")) is not el:
+                continue
+            cells = [self.__children(cell, True, depth).strip()
+                     for cell in row if cell.tag in ("th", "td")]
+            rows.append(cells)
+        if not rows:
+            return ""
+        if inline:
+            return " " + " ".join(cell for cells in rows for cell in cells) + " "
+
+        width = max(len(cells) for cells in rows)
+        lines = []
+        for i, cells in enumerate(rows):
+            cells = cells + [""] * (width - len(cells))
+            lines.append("| " + " | ".join(cells) + " |")
+            if i == 0:
+                lines.append("| " + " | ".join(["---"] * width) + " |")
+        return "\n\n" + "\n".join(lines) + "\n\n"
+
+
 class Converter:
-    def __init__(self, out_dir, remove_html, base_url):
+    def __init__(self, out_dir, remove_html, base_url, use_markdownify=False):
         self.__out_dir = out_dir
         self.__remove_html = remove_html
-        self.__base_url = base_url
+        self.__base_url_parsed = urlparse(base_url)
+        self.__use_markdownify = use_markdownify
+        self.__markdown_converter = CustomMarkdownConverter()
+        self.__lxml_converter = LxmlMarkdownConverter()
 
     def recurse_findfiles(self, path):
         """
         Recursively find all files in a given directory.
+        Directories are walked with an explicit stack rather than recursive generators.
         """
-        for entry in os.scandir(path):
-            if entry.is_dir(follow_symlinks=False):
-                yield from self.recurse_findfiles(entry.path)
-            elif entry.is_file(follow_symlinks=False):
-                yield entry
-            else:
-                raise NotImplementedError()
+        stack = [path]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+                    else:
+                        raise NotImplementedError()
+
+    def __attachment_url(self, path):
+        """
+        Build the absolute URL of a path under the Confluence wiki.
+        """
+        return urlunparse((self.__base_url_parsed.scheme, self.__base_url_parsed.netloc, f"/wiki/{path}",
+                           None, None, None))
 
-    def __convert_atlassian_html(self, soup):
+    def __find_markdown_video_link(self, text):
+        """
+        Find the first Markdown-style video link in the given text.
+        Return the link and the URL of its video, or None if there is no such link.
+        """
+        markdown_video_link = "![attachments/"
+        start_index = text.find(markdown_video_link)
+        if start_index < 0:
+            return None
+        end_index = text.find(")", start_index) + 1
+        markdown_video_link = text[start_index:end_index]
+
+        video_path = markdown_video_link.split('(')[-1].strip(')')
+        if not video_path.endswith(VIDEO_EXTENSIONS):
+            return None
+        return markdown_video_link, self.__attachment_url(video_path)
+
+    def __convert_atlassian_html(self, soup, replace_video_links):
         """
         Convert Atlassian-specific HTML tags to standard HTML tags and
         convert video links to HTML video embed format.
+        The document is walked once, dispatching on each node.
         """
-        base_url_parsed = urlparse(self.__base_url)
-
-        for image in soup.find_all("ac:image"):
-            attachment = image.find("ri:attachment")
-            if attachment:
-                filename = attachment.get("ri:filename")
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')):
-                    srcurl = os.path.join(ATTACHMENT_FOLDER_NAME, filename)
-                    imgtag = soup.new_tag("img", attrs={"src": srcurl, "alt": filename})
-                    image.replace_with(imgtag)
-                else:
-                    download_path = f"/wiki/download/attachments/{attachment.get('ri:attachment-id')}/{filename}"
-                    full_url = urlunparse((base_url_parsed.scheme, base_url_parsed.netloc, download_path, None, None, None))
-                    video_tag = soup.new_tag("video", controls=True)
-                    source_tag = soup.new_tag("source", src=full_url, type="video/mp4")
-                    video_tag.append(source_tag)
-                    image.replace_with(video_tag)
-
-        for attachment in soup.find_all("ac:link"):
-            if attachment.get("ac:link-type") == "attachment":
-                att_filename = attachment.get("ri:filename")
+        # Snapshot the nodes, as the tree is modified while walking it
+        for node in list(soup.descendants):
+            if isinstance(node, bs4.NavigableString):
+                if replace_video_links:
+                    self.__replace_markdown_video_link(soup, node)
+
+            elif node.name == "ac:image":
+                attachment = node.find("ri:attachment")
+                if attachment:
+                    filename = attachment.get("ri:filename")
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        srcurl = os.path.join(ATTACHMENT_FOLDER_NAME, filename)
+                        imgtag = soup.new_tag("img", attrs={"src": srcurl, "alt": filename})
+                        node.replace_with(imgtag)
+                    else:
+                        full_url = self.__attachment_url(
+                            f"download/attachments/{attachment.get('ri:attachment-id')}/{filename}")
+                        video_tag = soup.new_tag("video", controls=True)
+                        source_tag = soup.new_tag("source", src=full_url, type="video/mp4")
+                        video_tag.append(source_tag)
+                        node.replace_with(video_tag)
+
+            elif node.name == "ac:link" and node.get("ac:link-type") == "attachment":
+                att_filename = node.get("ri:filename")
                 attachment_tag = soup.new_tag("a", href=os.path.join(ATTACHMENT_FOLDER_NAME, att_filename))
                 attachment_tag.string = att_filename
-                attachment.replace_with(attachment_tag)
+                node.replace_with(attachment_tag)
 
         return soup
 
-    def convert(self):
+    def __replace_markdown_video_link(self, soup, text):
         """
-        Convert all HTML files in the output directory to Markdown.
-        Optionally remove the original HTML files after conversion.
+        Replace a Markdown-style video link with an HTML video tag in the given text node.
         """
-        for entry in self.recurse_findfiles(self.__out_dir):
-            path = entry.path
+        found = self.__find_markdown_video_link(text)
+        if found is None:
+            return
+        markdown_video_link, full_url = found
 
-            if not path.endswith(".html"):
-                continue
+        video_tag = soup.new_tag("video", controls=True)
+        source_tag = soup.new_tag("source", src=full_url, type="video/mp4")
+        video_tag.append(source_tag)
 
-            logging.info("Converting %s", path)
-            with open(path, "r", encoding="utf-8") as f:
-                data = f.read()
+        text.replace_with(text.replace(markdown_video_link, str(video_tag)))
 
-            soup_raw = bs4.BeautifulSoup(data, 'html.parser')
-            soup = self.__convert_atlassian_html(soup_raw)
+    @staticmethod
+    def __lxml_video(full_url):
+        """
+        Build an lxml video element playing the given URL.
+        """
+        video = lxml.html.Element("video", controls="controls")
+        video.append(lxml.html.Element("source", src=full_url, type="video/mp4"))
+        return video
 
-            # Convert the soup object back to HTML
-            converted_html = str(soup)
+    def __convert_atlassian_lxml(self, root, replace_video_links):
+        """
+        Convert Atlassian-specific tags of an lxml tree to standard HTML tags and
+        convert video links to HTML video embed format, in place.
+        """
+        # Snapshot the elements, as the tree is modified while walking it
+        for el in list(root.iter()):
+            if replace_video_links:
+                self.__replace_markdown_video_links_lxml(el)
+
+            if el.tag == "ac:image":
+                # ElementPath would need a prefix map for "ri:", so match the tag name with iter()
+                attachment = next(el.iter("ri:attachment"), None)
+                if attachment is None:
+                    continue
+                filename = attachment.get("ri:filename")
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    new_el = lxml.html.Element("img", src=os.path.join(ATTACHMENT_FOLDER_NAME, filename), alt=filename)
+                else:
+                    new_el = self.__lxml_video(self.__attachment_url(
+                        f"download/attachments/{attachment.get('ri:attachment-id')}/{filename}"))
 
-            # Replace Markdown-style video links with HTML video tags
-            converted_html = self.__replace_markdown_video_links(converted_html)
+            elif el.tag == "ac:link" and el.get("ac:link-type") == "attachment":
+                att_filename = el.get("ri:filename")
+                new_el = lxml.html.Element("a", href=os.path.join(ATTACHMENT_FOLDER_NAME, att_filename))
+                new_el.text = att_filename
 
-            md = CustomMarkdownConverter().convert(converted_html)
-            newname = os.path.splitext(path)[0]
-            with open(newname + ".md", "w", encoding="utf-8") as f:
-                f.write(md)
+            else:
+                continue
+
+            # replace() drops the tail of the old element, which is text that follows it
+            new_el.tail = el.tail
+            el.getparent().replace(el, new_el)
 
-            if self.__remove_html:
-                os.remove(path)
-                logging.info("Removed HTML file %s", path)
+        return root
 
-    def __replace_markdown_video_links(self, html_content):
+    def __replace_markdown_video_links_lxml(self, el):
         """
-        Replace Markdown-style video links with HTML video tags in the given HTML content.
+        Replace a Markdown-style video link in the text or tail of an lxml element with a video element.
         """
-        video_extensions = [".mp4", ".avi", ".mkv", ".mov", ".flv", ".wmv", ".m4v", ".webm"]
-        soup = bs4.BeautifulSoup(html_content, 'html.parser')
+        # Comments carry their content in text, which must be left alone
+        if isinstance(el.tag, str) and el.text:
+            found = self.__find_markdown_video_link(el.text)
+            if found is not None:
+                markdown_video_link, full_url = found
+                video = self.__lxml_video(full_url)
+                el.text, _, video.tail = el.text.partition(markdown_video_link)
+                el.insert(0, video)
+
+        if el.tail and el.getparent() is not None:
+            found = self.__find_markdown_video_link(el.tail)
+            if found is not None:
+                markdown_video_link, full_url = found
+                video = self.__lxml_video(full_url)
+                el.tail, _, video.tail = el.tail.partition(markdown_video_link)
+                el.addnext(video)
 
-        for text in soup.find_all(text=True):
-            new_content = text
-            for ext in video_extensions:
-                markdown_video_link = f"![attachments/"
-                if markdown_video_link in text:
-                    start_index = text.find(markdown_video_link)
-                    end_index = text.find(")", start_index) + 1
-                    markdown_video_link = text[start_index:end_index]
+    def convert(self):
+        """
+        Convert all HTML files in the output directory to Markdown.
+        Files are independent, so they are converted in parallel on a process pool.
+        """
+        # Filter on the entry name scandir already holds, before any file is opened
+        html_paths = [entry.path for entry in self.recurse_findfiles(self.__out_dir) if entry.name.endswith(".html")]
 
-                    video_path = markdown_video_link.split('(')[-1].strip(')')
-                    full_url = urlunparse((urlparse(self.__base_url).scheme, urlparse(self.__base_url).netloc, f"/wiki/{video_path}", None, None, None))
-                    video_tag = soup.new_tag("video", controls=True)
-                    source_tag = soup.new_tag("source", src=full_url, type="video/mp4")
-                    video_tag.append(source_tag)
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(self.convert_file, html_paths, chunksize=8))
 
-                    new_content = new_content.replace(markdown_video_link, str(video_tag))
+    def convert_file(self, path):
+        """
+        Convert a single HTML file to Markdown.
+        Optionally remove the original HTML file after conversion.
+        """
+        logging.info("Converting %s", path)
+        with open(path, "r", encoding="utf-8") as f:
+            data = f.read()
+
+        # lxml parses CDATA sections, which hold the body of code macros, as comments; keep them as text
+        data = re.sub(r"<!\[CDATA\[(.*?)\]\]>", lambda m: html.escape(m.group(1)), data, flags=re.S)
+
+        # Markdown-style video links are rare, so only look for them in pages that contain any
+        replace_video_links = "![attachments/" in data
+
+        if self.__use_markdownify:
+            # Parse once and rewrite the tree in place; markdownify consumes the soup directly
+            soup = self.__convert_atlassian_html(bs4.BeautifulSoup(data, 'lxml'), replace_video_links)
+            md = self.__markdown_converter.convert_soup(soup)
+        else:
+            try:
+                root = lxml.html.document_fromstring(data)
+            except lxml.etree.ParserError:
+                # lxml rejects documents without any element, such as empty or comment-only files
+                logging.warning("No content found in %s", path)
+                md = ""
+            else:
+                md = self.__lxml_converter.convert(self.__convert_atlassian_lxml(root, replace_video_links))
 
-            text.replace_with(new_content)
+        newname = os.path.splitext(path)[0]
+        with open(newname + ".md", "w", encoding="utf-8") as f:
+            f.write(md)
 
-        return str(soup)
+        if self.__remove_html:
+            os.remove(path)
+            logging.info("Removed HTML file %s", path)
 
 
 if __name__ == "__main__":
@@ -332,6 +840,8 @@ if __name__ == "__main__":
                         default=False, help="Remove HTML files after conversion")
     parser.add_argument("--removable-parents", type=str, nargs="*", default=[],
                         help="List of parent titles to be removed from the path")
+    parser.add_argument("--markdownify", action="store_true", dest="use_markdownify", required=False,
+                        default=False, help="Convert with BeautifulSoup and markdownify instead of the lxml converter")
 
     args = parser.parse_args()
 
@@ -342,5 +852,6 @@ if __name__ == "__main__":
         dumper.dump()
 
     # Convert HTML files to Markdown
-    converter = Converter(out_dir=args.out_dir, remove_html=args.remove_html, base_url=args.url)
+    converter = Converter(out_dir=args.out_dir, remove_html=args.remove_html, base_url=args.url,
+                          use_markdownify=args.use_markdownify)
     converter.convert()
@@ -0,0 +1,272 @@
+import re
+import copy
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+from main import Converter, Exporter
+
+BASE_URL = "https://example.atlassian.net"
+
+# Confluence storage format covering the markup the converters have to handle
+PAGE = (
+    '<h1>Title</h1>'
+    '<p>Some <strong>bold</strong> and <em>italic</em> text with a <a href="https://example.com/x">link</a>.</p>'
+    '<p>List&lt;String&gt; &amp; &lt;tag&gt;</p>'
+    '<p>## not a heading</p>'
+    '<p>1. not a list</p>'
+    '<ul><li>one</li><li>two<ul><li>nested</li></ul></li></ul>'
+    '<ol><li>first</li><li>second</li></ol>'
+    '<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">py</ac:parameter>'
+    '<ac:plain-text-body><![CDATA[print("x") & <y>]]></ac:plain-text-body></ac:structured-macro>'
+    '<table><tbody><tr><th>h1</th><th>h2</th></tr><tr><td>c1</td><td>c2</td></tr></tbody></table>'
+    '<ac:image ac:width="300"><ri:attachment ri:filename="diagram.png" /></ac:image>'
+    '<ac:image><ri:attachment ri:filename="clip.mp4" ri:attachment-id="42" /></ac:image>'
+    '<ac:link ac:link-type="attachment" ri:filename="spec.pdf"><ri:attachment ri:filename="spec.pdf" /></ac:link>'
+    '<div>Last updated: 2024-01-01</div>'
+)
+
+CONVERTERS = [pytest.param(False, id="lxml"), pytest.param(True, id="markdownify")]
+
+
+def convert(tmp_path, data, use_markdownify):
+    path = tmp_path / "page.html"
+    path.write_text(data, encoding="utf-8")
+    Converter(out_dir=str(tmp_path), remove_html=False, base_url=BASE_URL,
+              use_markdownify=use_markdownify).convert_file(str(path))
+    return (tmp_path / "page.md").read_text(encoding="utf-8")
+
+
+def test_converters_keep_the_same_text(tmp_path):
+    lxml_md = convert(tmp_path, PAGE, use_markdownify=False)
+    markdownify_md = convert(tmp_path, PAGE, use_markdownify=True)
+    # markdownify runs the code macro's language into its code, so compare the word characters only
+    assert "".join(re.findall(r"\w+", lxml_md)) == "".join(re.findall(r"\w+", markdownify_md))
+
+
+@pytest.mark.parametrize("use_markdownify, expected", [
+    pytest.param(False, '```py\nprint("x") & <y>\n```', id="lxml"),
+    pytest.param(True, 'print("x") \\& \\<y\\>', id="markdownify"),
+])
+def test_code_macro(tmp_path, use_markdownify, expected):
+    md = convert(tmp_path, PAGE, use_markdownify)
+    assert expected in md
+
+
+MULTILINE_CODE = ('<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">python</ac:parameter>'
+                  '<ac:plain-text-body><![CDATA[def f():\n    return 1 < 2]]></ac:plain-text-body>'
+                  '</ac:structured-macro>')
+
+
+@pytest.mark.parametrize("use_markdownify", CONVERTERS)
+def test_multiline_code_macro_keeps_line_breaks(tmp_path, use_markdownify):
+    md = convert(tmp_path, MULTILINE_CODE, use_markdownify)
+    assert re.search(r"def f\(\):\n *return 1", md)
+
+
+def test_multiline_code_macro_is_fenced(tmp_path):
+    md = convert(tmp_path, MULTILINE_CODE, use_markdownify=False)
+    assert md == "```python\ndef f():\n    return 1 < 2\n```\n"
+
+
+@pytest.mark.parametrize("use_markdownify", CONVERTERS)
+def test_escaped_text(tmp_path, use_markdownify):
+    md = convert(tmp_path, PAGE, use_markdownify)
+    assert "List\\<String\\> \\& \\<tag\\>" in md
+    assert "\\#\\# not a heading" in md
+    assert "1\\. not a list" in md
+
+
+@pytest.mark.parametrize("use_markdownify", CONVERTERS)
+def test_inline_formatting(tmp_path, use_markdownify):
+    md = convert(tmp_path, PAGE, use_markdownify)
+    assert "Title\n=====" in md
+    assert "Some **bold** and *italic* text with a [link](https://example.com/x)." in md
+
+
+@pytest.mark.parametrize("use_markdownify", CONVERTERS)
+def test_lists(tmp_path, use_markdownify):
+    md = convert(tmp_path, PAGE, use_markdownify)
+    assert "* one\n* two\n" in md
+    assert re.search(r"\n\s+\+ nested\n", md)
+    assert "1. first\n2. second" in md
+
+
+@pytest.mark.parametrize("use_markdownify", CONVERTERS)
+def test_table(tmp_path, use_markdownify):
+    md = convert(tmp_path, PAGE, use_markdownify)
+    assert "| h1 | h2 |\n| --- | --- |\n| c1 | c2 |" in md
+
+
+@pytest.mark.parametrize("use_markdownify", CONVERTERS)
+def test_attachments(tmp_path, use_markdownify):
+    md = convert(tmp_path, PAGE, use_markdownify)
+    assert "![diagram.png](attachments/diagram.png)" in md
+    assert "[spec.pdf](attachments/spec.pdf)" in md
+    assert ('<video controls><source src="https://example.atlassian.net/wiki/download/attachments/42/clip.mp4"'
+            ' type="video/mp4"></video>') in md
+
+
+def test_markdown_video_link(tmp_path):
+    md = convert(tmp_path, "<p>See ![attachments/demo](attachments/demo.mp4) and "
+                           "![attachments/pic](attachments/pic.png)</p>", use_markdownify=False)
+    assert ('See <video controls><source src="https://example.atlassian.net/wiki/attachments/demo.mp4"'
+            ' type="video/mp4"></video> and') in md
+    assert "![attachments/pic](attachments/pic.png)" in md
+
+
+def test_inline_code_with_backticks(tmp_path):
+    md = convert(tmp_path, "<p><code>a`b</code></p>", use_markdownify=False)
+    assert md == "``a`b``\n"
+
+
+def test_empty_inline_code(tmp_path):
+    assert convert(tmp_path, "<p><code></code>x</p>", use_markdownify=False) == "x\n"
+
+
+def test_blockquote(tmp_path):
+    md = convert(tmp_path, "<blockquote><p>q1</p> <p>q2</p></blockquote>", use_markdownify=False)
+    assert md == "> q1\n>\n> q2\n"
+
+
+def test_whitespace_between_blocks(tmp_path):
+    md = convert(tmp_path, "<p>text</p> <p>leading</p>\n<ul><li>item</li></ul>", use_markdownify=False)
+    assert md == "text\n\nleading\n\n* item\n"
+
+
+@pytest.mark.parametrize("data", ["", "  \n ", "<!-- comment -->"])
+def test_empty_page(tmp_path, data):
+    assert convert(tmp_path, data, use_markdownify=False) == ""
+
+
+IMAGE = b"\x89PNG" + bytes(range(256)) * 16
+
+
+class FakeConfluence:
+    """
+    In-memory Confluence space: a homepage with one child page that has an image attachment.
+    """
+
+    def __init__(self):
+        self.pages = {
+            "1": {"id": "1", "title": "Home", "version": {"number": 1, "when": "2024-01-01"}, "ancestors": [],
+                  "body": {"storage": {"value": "<p>home</p>"}}},
+            "2": {"id": "2", "title": "Child", "version": {"number": 1, "when": "2024-01-01"},
+                  "ancestors": [{"id": "1"}], "body": {"storage": {"value": "<p>child</p>"}}},
+        }
+        self.attachments = {"2": [{"title": "pic.png", "_links": {"download": "/download/attachments/2/pic.png"},
+                                   "metadata": {"mediaType": "image/png"}}]}
+        self.fetched = []
+
+    def get_all_spaces(self, start, limit, expand):
+        return {"size": 1, "results": [{"key": "SP", "homepage": {"id": "1"}}]}
+
+    def get_all_pages_from_space(self, space, start, limit, expand):
+        pages = list(self.pages.values())[start:start + limit]
+        if "body.storage" not in expand:
+            pages = [{k: v for k, v in page.items() if k != "body"} for page in pages]
+        return copy.deepcopy(pages)
+
+    def get_page_by_id(self, page_id, expand):
+        self.fetched.append(page_id)
+        return copy.deepcopy(self.pages[page_id])
+
+    def get_attachments_from_content(self, page_id, start, limit):
+        return {"results": self.attachments.get(page_id, [])}
+
+
+class AttachmentServer(ThreadingHTTPServer):
+    """
+    Serve the image attachment, optionally cutting the body short of its Content-Length.
+    """
+    truncate = False
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(IMAGE)))
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            self.wfile.write(IMAGE[:10] if self.server.truncate else IMAGE)
+
+        def log_message(self, *args):
+            pass
+
+
+@pytest.fixture
+def server():
+    server = AttachmentServer(("127.0.0.1", 0), AttachmentServer.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def confluence(monkeypatch):
+    confluence = FakeConfluence()
+    monkeypatch.setattr(main, "Confluence", lambda **kwargs: confluence)
+    return confluence
+
+
+def export(tmp_path, server, confluence, no_attach=False):
+    confluence.fetched.clear()
+    Exporter(url=f"http://127.0.0.1:{server.server_port}", username="user", token="token", out_dir=str(tmp_path),
+             space=None, no_attach=no_attach, removable_parents=[]).dump()
+    return confluence.fetched
+
+
+def read_manifest(tmp_path):
+    return json.loads((tmp_path / ".manifest.json").read_text(encoding="utf-8"))
+
+
+def test_export_skips_unchanged_pages(tmp_path, server, confluence):
+    # The first export takes the bodies from the space scan
+    assert export(tmp_path, server, confluence) == []
+    assert (tmp_path / "Home" / "Child.html").read_text(encoding="utf-8").startswith("<p>child</p>")
+    assert (tmp_path / "Home" / "attachments" / "pic.png").read_bytes() == IMAGE
+
+    assert export(tmp_path, server, confluence) == []
+
+    confluence.pages["2"]["version"]["number"] = 2
+    confluence.pages["2"]["body"]["storage"]["value"] = "<p>changed</p>"
+    assert export(tmp_path, server, confluence) == ["2"]
+    assert (tmp_path / "Home" / "Child.html").read_text(encoding="utf-8").startswith("<p>changed</p>")
+    assert read_manifest(tmp_path)["2"] == {"version": 2, "attachments": True}
+
+
+def test_export_skips_pages_converted_with_remove_html(tmp_path, server, confluence):
+    export(tmp_path, server, confluence)
+    Converter(out_dir=str(tmp_path), remove_html=True, base_url=BASE_URL).convert_file(
+        str(tmp_path / "Home" / "Child.html"))
+
+    assert export(tmp_path, server, confluence) == []
+    assert not (tmp_path / "Home" / "Child.html").exists()
+
+
+def test_export_fetches_attachments_skipped_by_the_last_export(tmp_path, server, confluence):
+    export(tmp_path, server, confluence, no_attach=True)
+    assert not (tmp_path / "Home" / "attachments" / "pic.png").exists()
+    assert read_manifest(tmp_path)["2"] == {"version": 1, "attachments": False}
+
+    assert export(tmp_path, server, confluence, no_attach=True) == []
+
+    assert sorted(export(tmp_path, server, confluence)) == ["1", "2"]
+    assert (tmp_path / "Home" / "attachments" / "pic.png").read_bytes() == IMAGE
+    assert read_manifest(tmp_path)["2"] == {"version": 1, "attachments": True}
+
+
+def test_export_retries_failed_downloads(tmp_path, server, confluence):
+    server.truncate = True
+    export(tmp_path, server, confluence)
+    assert not (tmp_path / "Home" / "attachments" / "pic.png").exists()
+    assert not (tmp_path / "Home" / "attachments" / "pic.png.part").exists()
+    assert "2" not in read_manifest(tmp_path)
+
+    server.truncate = False
+    assert export(tmp_path, server, confluence) == ["2"]
+    assert (tmp_path / "Home" / "attachments" / "pic.png").read_bytes() == IMAGE
+    assert read_manifest(tmp_path)["2"] == {"version": 1, "attachments": True}